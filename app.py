@@ -1,13 +1,25 @@
 # app.py
-# Streamlit "estable" (sin sliders/presets), JSON robusto con autorreparación
+# Streamlit "estable" (sin sliders/presets), JSON con esquema (response_schema) + reparación local
 
 import json
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from typing import Callable
 
+import httpx
+import pandas as pd
 import streamlit as st
 from google import genai
+from google.genai import types
 from google.oauth2 import service_account
 
+try:
+    import orjson
+except ImportError:  # sin wheel: se usa json de la stdlib
+    orjson = None
+
 
 # ============================================================
 # CONFIG FIJA (NO TOCAR)
@@ -24,11 +36,26 @@ GEN_CONFIG = {
     "seed": 20240317,            # seed fija para repetibilidad
 }
 
-REPAIR_CONFIG = {
-    "response_mime_type": "application/json",
-    "temperature": 0.0,          # reparación determinista
-    "max_output_tokens": 2048,
-}
+# Pool HTTP del cliente (vive con el cliente cacheado: reutiliza TCP+TLS entre submits)
+# + reintentos con backoff exponencial y jitter solo para errores transitorios
+HTTP_OPTIONS = types.HttpOptions(
+    timeout=120_000,             # ms; margen para respuestas largas
+    client_args={
+        "limits": httpx.Limits(max_connections=100, max_keepalive_connections=32),
+    },
+    retry_options=types.HttpRetryOptions(
+        attempts=4,              # incluye la llamada inicial
+        initial_delay=0.5,
+        max_delay=8.0,
+        http_status_codes=[408, 429, 500, 502, 503, 504],
+    ),
+)
+
+HISTORY_MAX = 20                 # entradas guardadas (y mostradas) por sesión
+
+# Caché de planes generados (compartida entre sesiones)
+RESULT_TTL_S = 24 * 3600
+RESULT_MAX_ENTRIES = 256
 
 SYSTEMS = [
     "Motor y admisión",
@@ -46,14 +73,97 @@ SYSTEMS = [
     "Neumáticos",
 ]
 
+TIPOS_TAREA = ["Sustitución", "Inspección", "Limpieza", "Ajuste", "Engrase"]
+NIVELES = ["Alta", "Media", "Baja"]
+
+# Presupuesto de salida: cabecera/listas fijas + tareas (sistemas elegidos × máx. tareas)
+MAX_TAREAS_POR_SISTEMA = 4
+MAX_ITEMS_LISTA = 5  # ref_partes, fuentes, consumibles, chequeos, suposiciones
+MAX_SUBITEMS = 4  # materiales / que_mirar
+TOKENS_BASE = 1024  # resumen + las 5 listas fijas llenas (≤ MAX_ITEMS_LISTA cada una)
+TOKENS_POR_TAREA = 90
+
+
+def _obj(properties: dict) -> dict:
+    """Objeto con todas sus propiedades obligatorias (orden = orden de salida)."""
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+def _arr(items: dict, **extra) -> dict:
+    return {"type": "array", "items": items, **extra}
+
+
+_STR = {"type": "string"}
+_INT = {"type": "integer"}
+
+
+def build_response_schema(systems: tuple[str, ...]) -> dict:
+    """
+    Esquema de salida: Vertex lo impone al decodificar (JSON siempre parseable,
+    sistemas/tipos/prioridades dentro de los valores permitidos).
+    """
+    return _obj(
+        {
+            "resumen": _obj(
+                {
+                    "marca": _STR,
+                    "modelo": _STR,
+                    "horas": _INT,
+                    "intervalo_mas_cercano_h": _INT,
+                    "razon_intervalo": _STR,
+                    "confianza": {"type": "string", "enum": NIVELES},
+                }
+            ),
+            "puntos_mantenimiento": _arr(
+                _obj(
+                    {
+                        "sistema": {"type": "string", "enum": list(systems)},
+                        "items": _arr(
+                            _obj(
+                                {
+                                    "tarea": _STR,
+                                    "tipo": {"type": "string", "enum": TIPOS_TAREA},
+                                    "prioridad": {"type": "string", "enum": NIVELES},
+                                    "frecuencia_h": _INT,
+                                    "tiempo_estimado_min": _INT,
+                                    "materiales": _arr(_STR, maxItems=MAX_SUBITEMS),
+                                    "notas": _STR,
+                                }
+                            ),
+                            maxItems=MAX_TAREAS_POR_SISTEMA,
+                        ),
+                    }
+                ),
+                maxItems=len(systems),
+            ),
+            "ref_partes": _arr(
+                _obj(
+                    {
+                        "pieza": _STR,
+                        "referencia": _STR,
+                        "motivo": _STR,
+                        "confianza": {"type": "string", "enum": NIVELES},
+                    }
+                ),
+                maxItems=MAX_ITEMS_LISTA,
+            ),
+            "fuentes": _arr(_obj({"titulo": _STR, "url": _STR, "nota": _STR}), maxItems=MAX_ITEMS_LISTA),
+            "consumibles_recomendados": _arr(
+                _obj({"nombre": _STR, "cantidad_aprox": _STR}), maxItems=MAX_ITEMS_LISTA
+            ),
+            "chequeos_criticos": _arr(
+                _obj({"alerta": _STR, "que_mirar": _arr(_STR, maxItems=MAX_SUBITEMS), "accion": _STR}),
+                maxItems=MAX_ITEMS_LISTA,
+            ),
+            "suposiciones": _arr(_STR, maxItems=MAX_ITEMS_LISTA),
+        }
+    )
+
 
 # ============================================================
 # UI (look limpio + algo de CSS)
 # ============================================================
-st.set_page_config(page_title="Puntos de mantenimiento Tractor", page_icon="🧰", layout="centered")
-
-st.markdown(
-    """
+_CSS = """
 <style>
 .block-container {max-width: 1100px; padding-top: 1.6rem; padding-bottom: 2.2rem;}
 #MainMenu, footer, header {visibility: hidden;}
@@ -95,25 +205,27 @@ div[data-testid="stForm"] {
   background: rgba(255,255,255,.03);
 }
 </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
 
-st.markdown(
-    """
+_HERO_HTML = """
 <div class="hero">
   <h1>🧰 Puntos de mantenimiento (por horas)</h1>
   <p>Introduce marca, modelo y horas. Checklist por sistemas + consumibles + críticos. Salida JSON descargable.</p>
 </div>
-""",
-    unsafe_allow_html=True,
-)
+"""
+
+st.set_page_config(page_title="Puntos de mantenimiento Tractor", page_icon="🧰", layout="centered")
+
+# Streamlit borra lo que no se vuelve a emitir en cada rerun: el CSS tiene que
+# enviarse siempre (no sirve "inyectarlo una vez" con cache_resource).
+st.markdown(_CSS, unsafe_allow_html=True)
+st.markdown(_HERO_HTML, unsafe_allow_html=True)
 
 st.markdown(
     f"<span class='pill'>Modelo: {MODEL_NAME}</span> "
     f"<span class='pill'>Temp: {GEN_CONFIG['temperature']}</span> "
     f"<span class='pill'>Seed: {GEN_CONFIG['seed']}</span> "
-    f"<span class='pill'>Tokens: {GEN_CONFIG['max_output_tokens']}</span>",
+    f"<span class='pill'>Tokens máx: {GEN_CONFIG['max_output_tokens']}</span>",
     unsafe_allow_html=True,
 )
 
@@ -121,10 +233,10 @@ st.markdown(
 # ============================================================
 # Vertex / Gemini (Streamlit secrets)
 # ============================================================
-def conectar_vertex_desde_streamlit(location: str = LOCATION) -> genai.Client:
+def _load_auth_info() -> dict:
     """
-    Conexión a Vertex AI usando service account guardada en st.secrets["google"].
-    Repara private_key si viene con \\n.
+    Lee st.secrets["google"] y devuelve el dict de service account listo para
+    google-auth. Repara private_key si viene con \\n.
     """
     if "google" not in st.secrets:
         raise ValueError("No existe st.secrets['google']. Añade el bloque [google] en secrets.")
@@ -145,7 +257,16 @@ def conectar_vertex_desde_streamlit(location: str = LOCATION) -> genai.Client:
     missing = [k for k in ("project_id", "private_key", "client_email") if not auth_info.get(k)]
     if missing:
         raise ValueError(f"Faltan campos en st.secrets['google']: {', '.join(missing)}")
+    return auth_info
+
 
+def conectar_vertex_desde_streamlit(location: str = LOCATION) -> genai.Client:
+    """
+    Conexión a Vertex AI usando service account guardada en st.secrets["google"].
+    Solo se llama desde get_client (cacheado), así que secrets + parseo de la
+    clave corren una vez por proceso y región.
+    """
+    auth_info = _load_auth_info()
     google_creds = service_account.Credentials.from_service_account_info(auth_info)
     scoped_creds = google_creds.with_scopes(["https://www.googleapis.com/auth/cloud-platform"])
 
@@ -154,182 +275,332 @@ def conectar_vertex_desde_streamlit(location: str = LOCATION) -> genai.Client:
         project=auth_info["project_id"],
         location=location,
         credentials=scoped_creds,
+        http_options=HTTP_OPTIONS,
     )
 
 
+def _warm_up(client: genai.Client, model_name: str = MODEL_NAME) -> None:
+    """Obtiene el token OAuth y abre la conexión TLS sin gastar tokens del modelo."""
+    try:
+        client.models.get(model=model_name)
+    except Exception:
+        pass  # solo es precalentamiento
+
+
 @st.cache_resource(show_spinner=False)
-def get_client() -> genai.Client:
-    return conectar_vertex_desde_streamlit()
+def get_client(location: str = LOCATION) -> genai.Client:
+    """
+    Cliente único por región, compartido entre sesiones y reruns.
+    Credenciales, scopes y conexión se construyen solo la primera vez.
+    """
+    client = conectar_vertex_desde_streamlit(location)
+    threading.Thread(target=_warm_up, args=(client,), daemon=True).start()
+    return client
+
+
+# Crea el cliente (y lo precalienta) mientras el usuario rellena el formulario.
+try:
+    get_client()
+except Exception:
+    pass  # el error real se muestra al pulsar Calcular
 
 
 # ============================================================
 # Prompt (acotado para evitar truncados)
+# La estructura la impone build_response_schema; aquí solo van las reglas.
+# Reglas fijas primero y todo lo variable (incl. sistemas) en "Datos" al final.
+# Hoy el prompt (~250 tokens) queda por debajo del mínimo de Vertex para el
+# caché implícito de prefijos, así que este orden no ahorra nada todavía.
 # ============================================================
-def build_prompt(marca: str, modelo: str, horas: int) -> str:
-    systems_txt = ", ".join([f'"{s}"' for s in SYSTEMS])
-
-    return f"""
+_PROMPT_TEMPLATE = """
 Eres un jefe de taller especialista en tractores agrícolas.
-Devuelve SOLO JSON válido (sin texto adicional, sin markdown).
+Genera el plan de mantenimiento por horas del tractor indicado en "Datos".
+
+Reglas:
+- En "resumen" copia marca, modelo y horas tal cual vienen en "Datos".
+- Cubre solo los sistemas listados en "Datos", uno por bloque.
+- Si no sabes intervalos exactos del modelo, usa intervalos típicos (250/500/1000/1500/2000h) y explícalo en "suposiciones".
+- Máximo {max_tareas} tareas por sistema (prioriza las más relevantes).
+- Evita cifras ultra específicas si no estás seguro; usa "aprox" y aclara en notas.
+- NO inventes referencias con confianza alta: si dudas, pon confianza "Baja" y explica motivo.
+- En "fuentes", si no tienes fuente real deja url vacío y explícalo en "nota".
+- Si la respuesta empieza a ser larga, REDUCE contenido (menos tareas, notas más cortas).
 
 Datos:
 - Marca: {marca}
 - Modelo: {modelo}
 - Horas actuales: {horas}
+- Sistemas a cubrir: [{systems_txt}]
+""".strip()
 
-Estructura exacta:
-
-{{
-  "resumen": {{
-    "marca": "{marca}",
-    "modelo": "{modelo}",
-    "horas": {horas},
-    "intervalo_mas_cercano_h": 0,
-    "razon_intervalo": "...",
-    "confianza": "Alta | Media | Baja"
-  }},
-  "puntos_mantenimiento": [
-    {{
-      "sistema": "Motor y admisión",
-      "items": [
-        {{
-          "tarea": "...",
-          "tipo": "Sustitución | Inspección | Limpieza | Ajuste | Engrase",
-          "prioridad": "Alta | Media | Baja",
-          "frecuencia_h": 0,
-          "tiempo_estimado_min": 0,
-          "materiales": ["..."],
-          "notas": "..."
-        }}
-      ]
-    }}
-  ],
-  "ref_partes": [
-    {{
-      "pieza": "Filtro aceite motor",
-      "referencia": "...",
-      "motivo": "...",
-      "confianza": "Alta | Media | Baja"
-    }}
-  ],
-  "fuentes": [
-    {{
-      "titulo": "...",
-      "url": "",
-      "nota": "si no tienes fuente real, deja url vacío y explica"
-    }}
-  ],
-  "consumibles_recomendados": [
-    {{
-      "nombre": "Aceite motor 15W-40",
-      "cantidad_aprox": "..."
-    }}
-  ],
-  "chequeos_criticos": [
-    {{
-      "alerta": "...",
-      "que_mirar": ["..."],
-      "accion": "..."
-    }}
-  ],
-  "suposiciones": ["..."]
-}}
 
-Reglas:
-- Sistemas permitidos (usa EXACTAMENTE uno de estos): [{systems_txt}]
-- Si no sabes intervalos exactos del modelo, usa intervalos típicos (250/500/1000/1500/2000h) y explícalo en "suposiciones".
-- Máximo 4 tareas por sistema (prioriza las más relevantes).
-- Evita cifras ultra específicas si no estás seguro; usa "aprox" y aclara en notas.
-- NO inventes referencias con confianza alta: si dudas, pon confianza "Baja" y explica motivo.
-- Si la respuesta empieza a ser larga, REDUCE contenido antes de romper el JSON. Cierra siempre llaves y listas.
-""".strip()
+def build_prompt(marca: str, modelo: str, horas: int, systems: tuple[str, ...] = tuple(SYSTEMS)) -> str:
+    return _PROMPT_TEMPLATE.format(
+        marca=marca,
+        modelo=modelo,
+        horas=horas,
+        systems_txt=", ".join(f'"{s}"' for s in systems),
+        max_tareas=MAX_TAREAS_POR_SISTEMA,
+    )
+
+
+def max_output_tokens(systems: tuple[str, ...]) -> int:
+    """Tope de tokens según lo que se pide (nunca por encima de GEN_CONFIG)."""
+    budget = TOKENS_BASE + TOKENS_POR_TAREA * MAX_TAREAS_POR_SISTEMA * len(systems)
+    return min(GEN_CONFIG["max_output_tokens"], budget)
 
 
 # ============================================================
 # JSON defensivo + reparación automática
 # ============================================================
-def _strip_code_fences(text: str) -> str:
+def _json_loads(text: str):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _json_dumps_pretty(data) -> str:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_json_object(text: str) -> dict:
+    """
+    Camino rápido: el texto entero es JSON (lo normal con response_schema).
+    Si trae basura alrededor (p. ej. fences ```json), decodifica desde el primer
+    '{' con raw_decode (ignora lo que sobre detrás, y no se confunde con '}'
+    dentro de strings).
+    """
     t = (text or "").strip()
-    if t.startswith("```"):
-        t = t.strip("`").strip()
-        if t.lower().startswith("json"):
-            t = t[4:].strip()
-    return t
+    try:
+        return _json_loads(t)
+    except ValueError:
+        pass
+    start = t.find("{")
+    if start == -1:
+        raise ValueError("La respuesta no contiene un objeto JSON.")
+    obj, _ = _JSON_DECODER.raw_decode(t, start)
+    return obj
 
 
-def _extract_json_object(text: str) -> str:
-    """Coge desde el primer '{' hasta el último '}'."""
+def _close_truncated_json(text: str) -> str:
+    """
+    Reparación local de un JSON cortado (típico al llegar a max_output_tokens):
+    recorta hasta el último valor completo y cierra listas/objetos abiertos.
+    """
     t = (text or "").strip()
-    a = t.find("{")
-    b = t.rfind("}")
-    if a != -1 and b != -1 and b > a:
-        return t[a : b + 1]
-    return t
+    t = t[t.find("{"):] if "{" in t else t
+
+    stack = []
+    in_str = escaped = False
+    cut, closers = 0, ""
+    for i, ch in enumerate(t):
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            cut, closers = i + 1, "".join(reversed(stack))
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            cut, closers = i + 1, "".join(reversed(stack))
+        elif ch == ",":
+            # el elemento anterior está completo; lo que siga puede no estarlo
+            cut, closers = i, "".join(reversed(stack))
+
+    return t[:cut] + closers
+
+
+_TOP_LEVEL_DEFAULTS = {
+    "resumen": dict,
+    "puntos_mantenimiento": list,
+    "ref_partes": list,
+    "fuentes": list,
+    "consumibles_recomendados": list,
+    "chequeos_criticos": list,
+    "suposiciones": list,
+}
 
 
-def _repair_json_with_model(client: genai.Client, bad_text: str) -> str:
-    """Pide al modelo que cierre/reponga el JSON sin cambiar estructura."""
-    repair_prompt = f"""
-El siguiente JSON está inválido o truncado. Arréglalo.
+def _normalize(data: dict) -> dict:
+    """
+    Rellena una sola vez las claves que faltan (un JSON reparado tras truncado
+    puede venir incompleto), para que las pestañas lean data["x"] directamente.
+    """
+    for key, factory in _TOP_LEVEL_DEFAULTS.items():
+        if not data.get(key):
+            data[key] = factory()
+    for bloque in data["puntos_mantenimiento"]:
+        if not bloque.get("items"):
+            bloque["items"] = []
+    return data
 
-Reglas:
-- Devuelve SOLO JSON válido (sin markdown, sin texto).
-- Mantén la misma estructura y campos.
-- Si falta el final, CIERRA correctamente listas y objetos.
-- NO añadas explicaciones fuera del JSON.
 
-JSON a reparar:
-{bad_text}
-""".strip()
+def _normalize_input(value: str) -> str:
+    """Colapsa espacios para que "John  Deere " y "John Deere" compartan caché."""
+    return " ".join(str(value).split())
 
-    # intentamos forzar JSON
-    try:
-        resp = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=repair_prompt,
-            config=REPAIR_CONFIG,
-        )
-        return _strip_code_fences(resp.text)
-    except Exception:
-        resp = client.models.generate_content(model=MODEL_NAME, contents=repair_prompt)
-        return _strip_code_fences(resp.text)
 
+class _ResultCache:
+    """
+    Planes ya generados, compartidos entre sesiones (LRU + TTL).
+    No usamos st.cache_data porque la llamada pinta el stream en la UI y
+    st.cache_data no puede reproducir elementos escritos fuera de la función.
+    """
+
+    def __init__(self, ttl_s: float, max_entries: int):
+        self._ttl_s = ttl_s
+        self._max_entries = max_entries
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            ts, value = hit
+            if time.monotonic() - ts > self._ttl_s:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: dict) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
 
-def call_ai(marca: str, modelo: str, horas: int) -> dict:
+
+@st.cache_resource(show_spinner=False)
+def _result_cache() -> _ResultCache:
+    return _ResultCache(ttl_s=RESULT_TTL_S, max_entries=RESULT_MAX_ENTRIES)
+
+
+def _generate_text_stream(
+    client: genai.Client,
+    model_name: str,
+    prompt: str,
+    config: dict,
+    on_text: Callable[[str], None] | None = None,
+) -> str:
+    """Consume el stream de Vertex; on_text recibe el texto acumulado tras cada chunk."""
+    parts = []
+    for chunk in client.models.generate_content_stream(model=model_name, contents=prompt, config=config):
+        if not chunk.text:
+            continue
+        parts.append(chunk.text)
+        if on_text is not None:
+            on_text("".join(parts))
+    return "".join(parts)
+
+
+def _call_ai_uncached(
+    marca: str,
+    modelo: str,
+    horas: int,
+    systems: tuple[str, ...],
+    model_name: str,
+    on_text: Callable[[str], None] | None = None,
+) -> tuple[dict, bool]:
+    """Devuelve (plan, truncado); truncado=True si hubo que cerrar un JSON cortado."""
     client = get_client()
-    prompt = build_prompt(marca, modelo, horas)
+    prompt = build_prompt(marca, modelo, horas, systems)
+    config = {
+        **GEN_CONFIG,
+        "max_output_tokens": max_output_tokens(systems),
+        "response_schema": build_response_schema(systems),
+    }
 
-    # 1) llamada principal
-    try:
-        resp = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-            config=GEN_CONFIG,
-        )
-        text = _strip_code_fences(resp.text)
-    except Exception:
-        # fallback si el SDK ignora config
-        resp = client.models.generate_content(model=MODEL_NAME, contents=prompt)
-        text = _strip_code_fences(resp.text)
+    # 1) llamada principal (streaming, salida restringida por el esquema;
+    #    los 429/5xx los reintenta el SDK según HTTP_OPTIONS)
+    text = _generate_text_stream(client, model_name, prompt, config, on_text)
 
     # 2) parse normal
-    text2 = _extract_json_object(text)
     try:
-        return json.loads(text2)
-    except Exception:
-        # 3) reparación
-        fixed = _repair_json_with_model(client, text2)
-        fixed2 = _extract_json_object(fixed)
-        return json.loads(fixed2)
+        return _normalize(_parse_json_object(text)), False
+    except ValueError:
+        # 3) con esquema solo puede fallar por truncado (max_output_tokens):
+        #    se rescata lo que haya, pero el plan queda incompleto
+        return _normalize(_parse_json_object(_close_truncated_json(text))), True
+
+
+def call_ai(
+    marca: str,
+    modelo: str,
+    horas: int,
+    systems: tuple[str, ...] = tuple(SYSTEMS),
+    model_name: str = MODEL_NAME,
+    on_text: Callable[[str], None] | None = None,
+) -> tuple[dict, bool]:
+    """
+    Plan de mantenimiento para (marca, modelo, horas) limitado a `systems`,
+    como (plan, truncado). Reenviar los mismos datos no vuelve a pagar red ni
+    tokens; los errores y los planes truncados no se cachean. on_text solo se
+    llama si hay que ir a Vertex.
+    """
+    systems = tuple(s for s in SYSTEMS if s in systems)  # orden canónico para la clave
+    key = (_normalize_input(marca), _normalize_input(modelo), int(horas), systems, model_name)
+    cache = _result_cache()
+    data = cache.get(key)
+    if data is not None:
+        return data, False
+
+    # Cada st.* del preview es un punto donde Streamlit puede cortar el script
+    # (RerunException/StopException, que heredan de BaseException) si el usuario
+    # vuelve a pulsar un botón. Se deja de pintar, se termina el stream, se
+    # guarda en caché y solo entonces se atiende el rerun (aunque la llamada
+    # falle): así es un acierto de caché y no una segunda llamada a Vertex.
+    interrupted: list[BaseException] = []
+
+    def _preview(text: str) -> None:
+        if interrupted:
+            return
+        try:
+            on_text(text)
+        except BaseException as e:
+            interrupted.append(e)
+
+    try:
+        data, truncated = _call_ai_uncached(*key, on_text=_preview if on_text is not None else None)
+        if not truncated:
+            cache.put(key, data)
+    finally:
+        if interrupted:
+            raise interrupted[0]
+    return data, truncated
+
+
+def _export(data: dict) -> tuple[str, str]:
+    """JSON bonito + nombre de fichero para descarga, calculados una sola vez."""
+    resumen = data["resumen"]
+    fn = f"mantenimiento_{resumen.get('marca','marca')}_{resumen.get('modelo','modelo')}_{resumen.get('horas','horas')}h.json"
+    return _json_dumps_pretty(data), fn.replace(" ", "_")
 
 
 # ============================================================
 # Session state
 # ============================================================
 if "history" not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history = deque(maxlen=HISTORY_MAX)
 if "last_data" not in st.session_state:
     st.session_state.last_data = None
+if "last_export" not in st.session_state:
+    st.session_state.last_export = None
 
 
 # ============================================================
@@ -349,6 +620,12 @@ with left:
             modelo = st.text_input("Modelo", placeholder="6120M, T7.230, Puma 150…")
 
         horas = st.number_input("Horas actuales", min_value=0, value=250, step=10)
+        sistemas = st.multiselect(
+            "Sistemas",
+            SYSTEMS,
+            default=SYSTEMS,
+            help="Menos sistemas = respuesta más corta y rápida.",
+        )
 
         submit = st.form_submit_button("🚀 Calcular mantenimiento", use_container_width=True)
 
@@ -359,15 +636,16 @@ with right:
     st.markdown("### 📌 Estado")
 
     if st.session_state.last_data:
-        resumen = st.session_state.last_data.get("resumen", {}) or {}
+        resumen = st.session_state.last_data["resumen"]
         st.metric("Confianza", resumen.get("confianza", "—"))
         st.metric("Intervalo cercano (h)", resumen.get("intervalo_mas_cercano_h", "—"))
     else:
         st.info("Rellena el formulario y pulsa **Calcular**.")
 
     if st.button("🧹 Borrar historial", use_container_width=True):
-        st.session_state.history = []
+        st.session_state.history = deque(maxlen=HISTORY_MAX)
         st.session_state.last_data = None
+        st.session_state.last_export = None
         st.success("Historial borrado.")
 
     st.markdown("</div>", unsafe_allow_html=True)
@@ -380,88 +658,160 @@ if submit:
     if not marca.strip() or not modelo.strip():
         st.error("Faltan datos: **marca** y **modelo** son obligatorios.")
         st.stop()
+    if not sistemas:
+        st.error("Elige al menos un **sistema**.")
+        st.stop()
 
     with st.status("Generando plan de mantenimiento…", expanded=True) as status:
         st.write("🧠 Llamando a Vertex…")
+        preview = st.empty()
+
+        def _on_stream(text: str) -> None:
+            n = text.count('"sistema"')
+            if n:
+                status.update(label=f"Generando plan de mantenimiento… ({n}/{len(sistemas)} sistemas)")
+            preview.code(text, language="json")
+
         try:
-            data = call_ai(marca.strip(), modelo.strip(), int(horas))
+            data, truncated = call_ai(marca.strip(), modelo.strip(), int(horas), tuple(sistemas), on_text=_on_stream)
         except Exception as e:
             status.update(label="Error", state="error")
             st.error(str(e))
             st.stop()
 
-        status.update(label="Listo", state="complete")
+        preview.empty()
+        if truncated:
+            status.update(label="Listo (plan incompleto)", state="complete")
+            st.warning(
+                "La respuesta de Vertex se cortó antes de terminar: el plan está **incompleto** "
+                "y no se guarda en caché. Pulsa **Calcular** de nuevo o elige menos sistemas."
+            )
+        else:
+            status.update(label="Listo", state="complete")
 
+    payload, filename = _export(data)  # se serializa una vez, no en cada rerun
     st.session_state.last_data = data
-    st.session_state.history.insert(
-        0,
+    st.session_state.last_export = (payload, filename)
+    st.session_state.history.appendleft(
         {
             "ts": datetime.now().isoformat(timespec="seconds"),
-            "inputs": {"marca": marca.strip(), "modelo": modelo.strip(), "horas": int(horas)},
+            "inputs": {"marca": marca.strip(), "modelo": modelo.strip(), "horas": int(horas), "sistemas": list(sistemas)},
             "data": data,
-        },
+            "_pretty": payload,
+        }
     )
 
 
 # ============================================================
 # OUTPUT (tabs)
 # ============================================================
+_CHECKLIST_COLUMNS = {
+    "hecho": st.column_config.CheckboxColumn("Hecho", width="small"),
+    "sistema": st.column_config.TextColumn("Sistema"),
+    "tarea": st.column_config.TextColumn("Tarea", width="large"),
+    "tipo": st.column_config.TextColumn("Tipo"),
+    "prioridad": st.column_config.TextColumn("Prioridad"),
+    "frecuencia_h": st.column_config.NumberColumn("Frecuencia (h)"),
+    "tiempo_estimado_min": st.column_config.NumberColumn("Tiempo (min)"),
+    "materiales": st.column_config.TextColumn("Materiales"),
+    "notas": st.column_config.TextColumn("Notas", width="large"),
+}
+
+
+def _checklist_rows(pm: list) -> list[dict]:
+    """Aplana puntos_mantenimiento -> una fila por tarea."""
+    rows = []
+    for bloque in pm:
+        sistema = bloque.get("sistema", "Sistema")
+        for it in bloque["items"]:
+            rows.append(
+                {
+                    "hecho": False,
+                    "sistema": sistema,
+                    "tarea": it.get("tarea", "Tarea"),
+                    "tipo": it.get("tipo", ""),
+                    "prioridad": it.get("prioridad", ""),
+                    "frecuencia_h": it.get("frecuencia_h"),
+                    "tiempo_estimado_min": it.get("tiempo_estimado_min"),
+                    "materiales": ", ".join([str(x) for x in it.get("materiales", []) or []]),
+                    "notas": it.get("notas", ""),
+                }
+            )
+    return rows
+
+
+@st.fragment
+def _render_checklist(data: dict | None) -> None:
+    """
+    Fragmento: marcar "Hecho" en el editor solo re-ejecuta esta función,
+    no el script entero (cabecera, formulario y el resto de pestañas).
+    """
+    if not data:
+        st.info("Sin resultados todavía.")
+        return
+
+    pm = data["puntos_mantenimiento"]
+    if not pm:
+        st.warning("No llegaron puntos de mantenimiento.")
+        return
+
+    df = pd.DataFrame.from_records(_checklist_rows(pm), columns=list(_CHECKLIST_COLUMNS))
+    for col in ("frecuencia_h", "tiempo_estimado_min"):
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+
+    resumen = data["resumen"]
+    # un solo componente (Arrow) en vez de columnas+checkbox+markdown por tarea;
+    # la key va ligada al plan para que los "hecho" no salten a otro tractor
+    st.data_editor(
+        df,
+        column_config=_CHECKLIST_COLUMNS,
+        disabled=[c for c in _CHECKLIST_COLUMNS if c != "hecho"],
+        hide_index=True,
+        use_container_width=True,
+        key=f"checklist_{resumen.get('marca')}_{resumen.get('modelo')}_{resumen.get('horas')}",
+    )
+
+
+@st.fragment
+def _render_json(export: tuple[str, str] | None) -> None:
+    """Fragmento: pulsar "Descargar" no re-ejecuta el resto de la página."""
+    if not export:
+        st.info("Sin resultados todavía.")
+        return
+
+    payload, filename = export
+    st.subheader("Salida JSON completa")
+    st.code(payload, language="json")
+    st.download_button(
+        "⬇️ Descargar JSON",
+        data=payload,
+        file_name=filename,
+        mime="application/json",
+        use_container_width=True,
+    )
+
+
 data = st.session_state.last_data
 tabs = st.tabs(["✅ Checklist", "🧾 Resumen", "🧩 Partes & fuentes", "📦 Consumibles", "⚠️ Críticos", "🧠 Suposiciones", "🧬 JSON", "🕘 Historial"])
 
 with tabs[0]:
-    if not data:
-        st.info("Sin resultados todavía.")
-    else:
-        pm = data.get("puntos_mantenimiento", []) or []
-        if not pm:
-            st.warning("No llegaron puntos de mantenimiento.")
-        else:
-            for bloque in pm:
-                sistema = bloque.get("sistema", "Sistema")
-                items = bloque.get("items", []) or []
-                st.markdown(f"### {sistema}")
-                for it in items:
-                    tarea = it.get("tarea", "Tarea")
-                    prioridad = it.get("prioridad", "")
-                    tipo = it.get("tipo", "")
-                    freq = it.get("frecuencia_h", "")
-                    tmin = it.get("tiempo_estimado_min", "")
-                    materiales = it.get("materiales", []) or []
-                    notas = it.get("notas", "")
-
-                    cols = st.columns([0.06, 0.94])
-                    with cols[0]:
-                        st.checkbox("", value=False, key=f"chk_{sistema}_{tarea}_{freq}_{tmin}")
-                    with cols[1]:
-                        st.markdown(
-                            f"**{tarea}**  \n"
-                            f"<span class='pill'>Tipo: {tipo}</span> "
-                            f"<span class='pill'>Prioridad: {prioridad}</span> "
-                            f"<span class='pill'>Frecuencia(h): {freq}</span> "
-                            f"<span class='pill'>Tiempo(min): {tmin}</span>",
-                            unsafe_allow_html=True,
-                        )
-                        if materiales:
-                            st.caption("Materiales: " + ", ".join([str(x) for x in materiales]))
-                        if notas:
-                            st.caption(notas)
+    _render_checklist(data)
 
 with tabs[1]:
     if not data:
         st.info("Sin resultados todavía.")
     else:
         st.subheader("Resumen")
-        st.json(data.get("resumen", {}) or {})
+        st.json(data["resumen"])
 
 with tabs[2]:
     if not data:
         st.info("Sin resultados todavía.")
     else:
         st.subheader("Ref. de partes")
-        st.json(data.get("ref_partes", []) or [])
+        st.json(data["ref_partes"])
         st.subheader("Fuentes")
-        st.json(data.get("fuentes", []) or [])
+        st.json(data["fuentes"])
         st.warning("Si 'fuentes.url' viene vacío, NO hay grounding real: referencias aproximadas.")
 
 with tabs[3]:
@@ -469,52 +819,36 @@ with tabs[3]:
         st.info("Sin resultados todavía.")
     else:
         st.subheader("Consumibles recomendados")
-        st.json(data.get("consumibles_recomendados", []) or [])
+        st.json(data["consumibles_recomendados"])
 
 with tabs[4]:
     if not data:
         st.info("Sin resultados todavía.")
     else:
         st.subheader("Chequeos críticos")
-        st.json(data.get("chequeos_criticos", []) or [])
+        st.json(data["chequeos_criticos"])
 
 with tabs[5]:
     if not data:
         st.info("Sin resultados todavía.")
     else:
         st.subheader("Suposiciones")
-        st.json(data.get("suposiciones", []) or [])
+        st.json(data["suposiciones"])
 
 with tabs[6]:
-    if not data:
-        st.info("Sin resultados todavía.")
-    else:
-        st.subheader("Salida JSON completa")
-        st.code(json.dumps(data, ensure_ascii=False, indent=2), language="json")
-
-        resumen = data.get("resumen", {}) or {}
-        fn = f"mantenimiento_{resumen.get('marca','marca')}_{resumen.get('modelo','modelo')}_{resumen.get('horas','horas')}h.json"
-        fn = fn.replace(" ", "_")
-
-        st.download_button(
-            "⬇️ Descargar JSON",
-            data=json.dumps(data, ensure_ascii=False, indent=2),
-            file_name=fn,
-            mime="application/json",
-            use_container_width=True,
-        )
+    _render_json(st.session_state.last_export)
 
 with tabs[7]:
     st.subheader("Historial")
     if not st.session_state.history:
         st.info("No hay historial todavía.")
     else:
-        for i, item in enumerate(st.session_state.history[:20], start=1):
+        for i, item in enumerate(st.session_state.history, start=1):
             inputs = item.get("inputs", {})
             ts = item.get("ts", "")
             with st.expander(f"{i}. {inputs.get('marca','?')} {inputs.get('modelo','?')} — {inputs.get('horas','?')}h · {ts}", expanded=False):
                 st.json(inputs)
-                st.code(json.dumps(item.get("data", {}), ensure_ascii=False, indent=2), language="json")
+                st.code(item["_pretty"], language="json")
 
 st.divider()
 st.caption("Requiere Streamlit Secrets: bloque [google] con project_id, client_email y private_key.")
@@ -1,16 +1,24 @@
 import os
 from nicegui import ui
 
-def doblar():
-    try:
-        salida.value = str(float(entrada.value) * 2)
-    except Exception:
-        salida.value = "Valor inválido"
+PORT = int(os.getenv("PORT", "8080"))
 
-ui.label("Demo NiceGUI")
-entrada = ui.input(label="Valor", value="0")
-ui.button("Doblar", on_click=doblar)
-salida = ui.input(label="Resultado").props("readonly")
 
-port = int(os.getenv("PORT", "8080"))
-ui.run(host="0.0.0.0", port=port)
+@ui.page("/")
+def index():
+    # Widgets por sesión: cada navegador tiene su propia entrada/salida
+    def doblar():
+        try:
+            salida.value = str(float(entrada.value) * 2)
+        except Exception:
+            salida.value = "Valor inválido"
+
+    ui.label("Demo NiceGUI")
+    entrada = ui.input(label="Valor", value="0")
+    ui.button("Doblar", on_click=doblar)
+    salida = ui.input(label="Resultado").props("readonly")
+
+
+# ui.run solo al ejecutar el script (NiceGUI relanza el módulo como __mp_main__)
+if __name__ in {"__main__", "__mp_main__"}:
+    ui.run(host="0.0.0.0", port=PORT)